@@ -5,15 +5,36 @@ import binascii
 import re
 import codecs
 import getpass
+import decimal
+import datetime
+import hashlib
+import io
+from multiprocessing.pool import ThreadPool
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
 
 class MsSql2Pg:
     def __init__(self):
+        self.param_sql_engine = None
         self.param_sql_session = None
+        self.param_sql_session_maker = None
         self.param_output_file = None
         self.param_destination_database = None
         self.param_exclude_schemas = None
         self.param_max_record_count = None
         self.param_underscore_identifiers = False
+        self.param_clustered_order = False
+        self.param_analyze_jobs = None
+        self.param_subset_roots = None
+        self.param_subset_children = None
+        self.param_verify_file = None
+        self.param_verify_target = None
+        self.param_verify_chunks = None
+        self.param_verify_jobs = None
+        self.param_verify_leaf_rows = 1000
 
         self.schemas = None
         self.tables = None
@@ -23,6 +44,9 @@ class MsSql2Pg:
         self.constraints_check = None
         self.constraints_fk = None
         self.indexes = None
+        self.partitions = None
+        self.clustered_indexes = None
+        self.subset = None
 
     def read_command_line_params(self):
         parser = argparse.ArgumentParser(description='''
@@ -53,8 +77,59 @@ Produces .sql script that can be executed with psql.
                             help='Comma separated (no spaces) list of schemas that will be excluded from export.' +
                                  ' If not provided, all schemas will be processed.\n')
 
+        parser.add_argument('-c', '--clustered-order', action='store_true', default=False, dest='clustered_order',
+                            help='Read table data in the order of the SQL Server clustered index key,' +
+                                 ' so PostgreSQL tables are loaded physically clustered.')
+
+        parser.add_argument('-j', '--analyze-jobs', dest='analyze_jobs', default=0, type=int,
+                            help='Run final ANALYZE through vacuumdb with provided number of parallel jobs' +
+                                 ' instead of per-table ANALYZE statements. vacuumdb must be able to connect' +
+                                 ' with the same PG* environment as psql.')
+
+        parser.add_argument('-r', '--subset-root', dest='subset_roots', default=[], action='append',
+                            help='Export a referentially consistent subset: rows of TABLE matching optional' +
+                                 ' WHERE predicate plus all rows they reference. Format is TABLE[:PREDICATE],' +
+                                 ' TABLE is schema.table or table for dbo. May be repeated. Tables outside' +
+                                 ' the subset are created empty.')
+
+        parser.add_argument('--subset-children', dest='subset_children', default=0, type=int,
+                            help='With --subset-root, also export up to provided number of rows from each' +
+                                 ' table referencing a root table.')
+
+        parser.add_argument('--verify', dest='verify_file', default=None,
+                            help='Instead of producing a script, compare per-chunk row counts and hashes of the' +
+                                 ' source tables with the data of a previously produced script, and report' +
+                                 ' mismatching chunks and rows. Offline stand-in for --verify-target.' +
+                                 ' Requires SQL Server 2019 (UTF-8 collations).')
+
+        parser.add_argument('--verify-target', dest='verify_target', default=None,
+                            help='Like --verify, but compare with a live PostgreSQL database given as libpq' +
+                                 ' connection string, e.g. "host=pg dbname=db user=u". Requires psycopg2.')
+
+        parser.add_argument('--verify-chunks', dest='verify_chunks', default=16, type=int,
+                            help='Number of primary key ranges each table (and each mismatching range) is split' +
+                                 ' into by --verify and --verify-target.')
+
+        parser.add_argument('--verify-jobs', dest='verify_jobs', default=4, type=int,
+                            help='Number of tables verified in parallel, each on its own connection.')
+
         args = parser.parse_args()
 
+        if args.verify_file is not None and args.verify_target is not None:
+            parser.error('--verify and --verify-target cannot be used together')
+
+        if args.verify_target is not None and psycopg2 is None:
+            parser.error('--verify-target requires psycopg2')
+
+        if len(args.subset_roots) > 0 and args.record_count != float("inf"):
+            parser.error('-n/--limit_records cannot be combined with -r/--subset-root, it would break foreign keys')
+
+        if len(args.subset_roots) == 0 and args.subset_children != 0:
+            parser.error('--subset-children requires -r/--subset-root')
+
+        if len(args.subset_roots) > 0 and (args.verify_file is not None or args.verify_target is not None):
+            parser.error('-r/--subset-root cannot be combined with --verify/--verify-target, tables are verified in full')
+
         if args.password is None:
             args.password = getpass.getpass('Password:')
 
@@ -62,7 +137,10 @@ Produces .sql script that can be executed with psql.
             args.login_name, args.password, args.host_name, args.database_name)
         engine = create_engine(connection_string)
 
-        self.param_sql_session = sessionmaker(bind=engine, autocommit=True)()
+        self.param_sql_engine = engine
+
+        self.param_sql_session_maker = sessionmaker(bind=engine, autocommit=True)
+        self.param_sql_session = self.param_sql_session_maker()
         self.param_output_file = args.output_file_name
 
         if args.destination_database != '':
@@ -77,6 +155,14 @@ Produces .sql script that can be executed with psql.
 
         self.param_underscore_identifiers = args.underscore_identifiers
         self.param_max_record_count = args.record_count
+        self.param_clustered_order = args.clustered_order
+        self.param_analyze_jobs = args.analyze_jobs
+        self.param_subset_roots = args.subset_roots
+        self.param_subset_children = args.subset_children
+        self.param_verify_file = args.verify_file
+        self.param_verify_target = args.verify_target
+        self.param_verify_chunks = max(args.verify_chunks, 2)
+        self.param_verify_jobs = args.verify_jobs
 
     def run(self):
         self.read_command_line_params()
@@ -98,6 +184,8 @@ Produces .sql script that can be executed with psql.
                 self.columns = self.read_columns()
                 self.output_progress('reading computed columns')
                 self.read_computed_columns(self.columns)
+                self.output_progress('reading partitions')
+                self.partitions = self.read_partitions()
                 self.output_progress('reading identity columns')
                 self.sequences = self.read_identity_columns()
                 self.output_progress('reading primary, unique key constraints')
@@ -108,6 +196,25 @@ Produces .sql script that can be executed with psql.
                 self.constraints_fk = self.read_constraints_fk()
                 self.output_progress('reading indexes')
                 self.indexes = self.read_indexes()
+                self.output_progress('reading clustered indexes')
+                self.clustered_indexes = self.read_clustered_indexes()
+                if len(self.param_subset_roots) > 0:
+                    # #temp key tables live on one connection, so subset and data export must share it
+                    self.param_sql_session.close()
+                    self.param_sql_session = self.param_sql_engine.connect()
+
+                    self.output_progress('computing subset key sets')
+                    self.subset = self.read_subset()
+
+                if self.param_verify_file is not None or self.param_verify_target is not None:
+                    if self.param_verify_file is not None:
+                        self.output_progress('reading target data')
+                        target = self.read_verify_target()
+                    else:
+                        target = None
+                    self.output_progress('verifying data')
+                    self.output_verification(target)
+                    return
 
                 self.output_progress('writing database')
                 self.output_database()
@@ -129,6 +236,9 @@ Produces .sql script that can be executed with psql.
 
                 self.output_progress('writing foreign key constraints')
                 self.output_fk_constraints()
+
+                self.output_progress('writing statistics')
+                self.output_analyze()
             finally:
                 self.param_sql_session.close()
         finally:
@@ -174,6 +284,29 @@ Produces .sql script that can be executed with psql.
 
         return result
 
+    def original_table_name(self, schema, table):
+        if schema == 'dbo':
+            result = '[{}]'.format(table)
+        else:
+            result = '[{}].[{}]'.format(schema, table)
+
+        return result
+
+    def original_column_type(self, column):
+        column_type = column['type'].lower()
+
+        if column_type in ('varchar', 'nvarchar', 'char', 'nchar', 'varbinary', 'binary'):
+            result = '{}({}){}'.format(
+                column_type,
+                'MAX' if column['char_length'] == -1 else column['char_length'],
+                '' if column['collation'] is None else ' COLLATE {}'.format(column['collation']))
+        elif column_type in ('decimal', 'numeric'):
+            result = '{}({}, {})'.format(column_type, column['precision'], column['scale'])
+        else:
+            result = column_type
+
+        return result
+
     def translate_column_type(self, column):
         column_type = column['type'].lower()
 
@@ -250,6 +383,67 @@ Produces .sql script that can be executed with psql.
 
         return result
 
+    def translate_filter_definition(self, definition, table_columns):
+        # Returns translated predicate and whether PostgreSQL can take it as is
+        if definition is None:
+            return None, True
+
+        translatable = True
+
+        # String literals are kept as they are, only their N prefix goes; odd parts are literals
+        parts = re.split(r"((?:\bN)?'(?:[^']|'')*')", definition)
+        for i in range(0, len(parts), 2):
+            code = parts[i]
+
+            # bit columns are BOOLEAN in PostgreSQL, so comparisons with (0)/(1) become false/true
+            for column in table_columns:
+                if column['translated_type'] == 'BOOLEAN':
+                    reference = r'\[{}\]'.format(re.escape(column['name']))
+                    code = re.sub(
+                        r'({}\s*(?:=|<>|!=)\s*)(?:\(\s*([01])\s*\)|([01])\b)'.format(reference),
+                        lambda m: '{}{}'.format(m.group(1), 'true' if (m.group(2) or m.group(3)) == '1' else 'false'),
+                        code)
+                    if re.search(r'{}\s*(?!\s*(?:=|<>|!=)\s*(?:true|false)\b|\s*IS\b)\S'.format(reference),
+                                 code, re.IGNORECASE):
+                        translatable = False
+
+            # [Column] references become translated identifiers
+            parts[i] = re.sub(r'\[([^\]]+)\]', lambda m: self.translate_a_name(m.group(1)), code)
+
+        for i in range(1, len(parts), 2):
+            if parts[i].startswith('N'):
+                parts[i] = parts[i][1:]
+
+        return ''.join(parts), translatable
+
+    def translate_boundary_value(self, value):
+        if isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool):
+            result = str(value)
+        else:
+            result = "'{}'".format(str(value).replace("'", "''"))
+
+        return result
+
+    def translate_next_value(self, value):
+        # Smallest value above an inclusive boundary, None where the column precision is unknown
+        if isinstance(value, int) and not isinstance(value, bool):
+            result = value + 1
+        elif isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+            result = value + datetime.timedelta(days=1)
+        else:
+            result = None
+
+        return result
+
+    def translate_fill_factor(self, fill_factor):
+        # SQL Server 0 means 100, PostgreSQL takes 10..100
+        if fill_factor is None or fill_factor == 0 or fill_factor >= 100:
+            result = None
+        else:
+            result = max(fill_factor, 10)
+
+        return result
+
     def translate_data(self, data, data_type):
         data_type = data_type.upper()
         if data is None:
@@ -314,14 +508,10 @@ ORDER BY TABLE_SCHEMA, TABLE_NAME
             if row["TABLE_SCHEMA"] not in self.param_exclude_schemas:
                 translated_name = self.translate_table_name(row["TABLE_SCHEMA"], row["TABLE_NAME"])
 
-                if row["TABLE_SCHEMA"] == 'dbo':
-                    original_name = '[{}]'.format(row["TABLE_NAME"])
-                else:
-                    original_name = '[{}].[{}]'.format(row["TABLE_SCHEMA"], row["TABLE_NAME"])
-
                 result.append({
-                    'original_name': original_name,
+                    'original_name': self.original_table_name(row["TABLE_SCHEMA"], row["TABLE_NAME"]),
                     'translated_name': translated_name,
+                    'relation_name': self.translate_a_name(row["TABLE_NAME"]),
                 })
 
         return result
@@ -336,7 +526,8 @@ SELECT TABLE_SCHEMA,
   DATA_TYPE,
   CHARACTER_MAXIMUM_LENGTH,
   NUMERIC_PRECISION,
-  NUMERIC_SCALE
+  NUMERIC_SCALE,
+  COLLATION_NAME
 FROM INFORMATION_SCHEMA.COLUMNS
 ORDER BY TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION
         """)
@@ -352,6 +543,7 @@ ORDER BY TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION
                 char_length=row['CHARACTER_MAXIMUM_LENGTH'],
                 precision=row['NUMERIC_PRECISION'],
                 scale=row['NUMERIC_SCALE'],
+                collation=row['COLLATION_NAME'],
             )
 
             table_column['translated_name'] = self.translate_a_name(row['COLUMN_NAME'])
@@ -383,12 +575,13 @@ INNER JOIN SYS.SCHEMAS S
 
     def read_constraints_pk_uk(self):
         r = self.param_sql_session.execute("""
-SELECT u.TABLE_SCHEMA, u.TABLE_NAME, u.COLUMN_NAME, c.CONSTRAINT_TYPE
-FROM INFORMATION_SCHEMA.CONSTRAINT_COLUMN_USAGE u
+SELECT u.TABLE_SCHEMA, u.TABLE_NAME, u.COLUMN_NAME, u.CONSTRAINT_NAME, u.ORDINAL_POSITION, c.CONSTRAINT_TYPE
+FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE u
 INNER JOIN INFORMATION_SCHEMA.TABLE_CONSTRAINTS c
   ON  c.CONSTRAINT_NAME = u.CONSTRAINT_NAME
   AND c.CONSTRAINT_SCHEMA = u.CONSTRAINT_SCHEMA
 WHERE c.CONSTRAINT_TYPE IN ('UNIQUE', 'PRIMARY KEY')
+ORDER BY u.TABLE_SCHEMA, u.TABLE_NAME, u.CONSTRAINT_NAME, u.ORDINAL_POSITION
         """)
 
         result = []
@@ -397,8 +590,10 @@ WHERE c.CONSTRAINT_TYPE IN ('UNIQUE', 'PRIMARY KEY')
                 table_name = self.translate_table_name(row["TABLE_SCHEMA"], row["TABLE_NAME"])
                 pk = {
                     'type': row['CONSTRAINT_TYPE'],
+                    'name': row['CONSTRAINT_NAME'],
                     'table': table_name,
                     'column': self.translate_a_name(row['COLUMN_NAME']),
+                    'original_column': row['COLUMN_NAME'],
                 }
                 result.append(pk)
 
@@ -451,7 +646,7 @@ JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE KCU2
   AND KCU2.CONSTRAINT_NAME = RC.UNIQUE_CONSTRAINT_NAME
 WHERE KCU1.ORDINAL_POSITION = KCU2.ORDINAL_POSITION
   AND KCU1.TABLE_SCHEMA not in ('sys', 'guest', 'information_schema', 'elms', 'rms', 'rms_old')
-ORDER BY CONSTRAINT_SCHEMA, CONSTRAINT_NAME
+ORDER BY CONSTRAINT_SCHEMA, CONSTRAINT_NAME, ORDINAL_POSITION
         """)
 
         result = []
@@ -459,10 +654,13 @@ ORDER BY CONSTRAINT_SCHEMA, CONSTRAINT_NAME
             table_name = self.translate_table_name(row["TABLE_SCHEMA"], row["TABLE_NAME"])
             pk_table_name = self.translate_table_name(row["UNIQUE_TABLE_SCHEMA"], row["UNIQUE_TABLE_NAME"])
             pk = {
+                'name': '{}.{}'.format(row['CONSTRAINT_SCHEMA'], row['CONSTRAINT_NAME']),
                 'table': table_name,
                 'column': self.translate_a_name(row['COLUMN_NAME']),
+                'original_column': row['COLUMN_NAME'],
                 'pk_table': pk_table_name,
                 'pk_column': self.translate_a_name(row['UNIQUE_COLUMN_NAME']),
+                'original_pk_column': row['UNIQUE_COLUMN_NAME'],
             }
             result.append(pk)
 
@@ -474,7 +672,12 @@ SELECT sch.name as TABLE_SCHEMA,
      t.name as TABLE_NAME,
      ind.name as INDEX_NAME,
      ind.index_id as INDEX_ID,
-     ic.index_column_id as COLUMN_ID,
+     ind.is_unique as IS_UNIQUE,
+     ind.type as INDEX_TYPE,
+     ind.fill_factor as FILL_FACTOR,
+     ind.filter_definition as FILTER_DEFINITION,
+     ic.is_descending_key as IS_DESCENDING_KEY,
+     ic.is_included_column as IS_INCLUDED_COLUMN,
      col.name as COLUMN_NAME
 FROM sys.indexes ind
 INNER JOIN sys.index_columns ic
@@ -488,48 +691,338 @@ INNER JOIN sys.tables t
 INNER JOIN sys.schemas sch
   ON sch.schema_id = t.schema_id
 WHERE ind.is_primary_key = 0
-  AND ind.is_unique = 0
   AND ind.is_unique_constraint = 0
+  AND ind.is_hypothetical = 0
+  AND ind.type IN (1, 2)
   AND t.is_ms_shipped = 0
   AND sch.name not in ('sys', 'guest', 'information_schema', 'elms', 'rms', 'rms_old')
-ORDER BY t.name, ind.name, ind.index_id, ic.index_column_id
+ORDER BY sch.name, t.name, ind.index_id, ic.is_included_column, ic.key_ordinal, ic.index_column_id
         """)
 
-        new_indexes = {}
+        # PostgreSQL index names are unique per schema, SQL Server ones only per table
+        index_names = {}
         result = []
-        index = {}
+        index = None
         for row in r:
             if row['TABLE_SCHEMA'] not in self.param_exclude_schemas:
-                if row["COLUMN_ID"] == 1:
-                    if len(index.keys()) > 0:
-                        result.append(index)
-
-                    table_name = self.translate_table_name(row["TABLE_SCHEMA"], row["TABLE_NAME"])
-                    index_name = self.translate_a_name(row['TABLE_NAME'])
-                    if index_name.startswith('"'):
-                        index_name = '"index_{}'.format(index_name[1:])
-                    else:
-                        index_name = 'index_{}'.format(index_name)
+                table_name = self.translate_table_name(row["TABLE_SCHEMA"], row["TABLE_NAME"])
 
+                if index is None or index['table_name'] != table_name or index['index_id'] != row['INDEX_ID']:
+                    index_name = self.translate_a_name(row['INDEX_NAME'])
+                    name_key = (row['TABLE_SCHEMA'], index_name)
 
-                    if index_name in new_indexes:
-                        if new_indexes[index_name] == 0:
-                            new_indexes[index_name] = 2
+                    if name_key in index_names:
+                        index_names[name_key] += 1
+                        if index_name.endswith('"'):
+                            index_name = '{}{}"'.format(index_name[0:len(index_name)-1], index_names[name_key])
                         else:
-                            new_indexes[index_name] += 1
-
-                        index_name = '{}{}'.format(index_name, new_indexes[index_name])
+                            index_name = '{}{}'.format(index_name, index_names[name_key])
                     else:
-                        index_id = 0
-                        new_indexes[index_name] = 0
+                        index_names[name_key] = 1
+
+                    index_filter, filter_translatable = self.translate_filter_definition(
+                        row['FILTER_DEFINITION'], self.columns.get(table_name, []))
 
                     index = dict(
                         table_name=table_name,
+                        index_id=row['INDEX_ID'],
                         index_name=index_name,
+                        unique=bool(row['IS_UNIQUE']),
+                        clustered=row['INDEX_TYPE'] == 1,
+                        fill_factor=self.translate_fill_factor(row['FILL_FACTOR']),
+                        filter=index_filter,
+                        filter_translatable=filter_translatable,
+                        columns=[],
+                        included_columns=[],
+                    )
+                    result.append(index)
+
+                column_name = self.translate_a_name(row['COLUMN_NAME'])
+                if row['IS_INCLUDED_COLUMN']:
+                    index['included_columns'].append(column_name)
+                elif row['IS_DESCENDING_KEY']:
+                    index['columns'].append('{} DESC'.format(column_name))
+                else:
+                    index['columns'].append(column_name)
+
+        return result
+
+    def read_partitions(self):
+        r = self.param_sql_session.execute("""
+SELECT sch.name as TABLE_SCHEMA,
+     t.name as TABLE_NAME,
+     col.name as COLUMN_NAME,
+     pf.name as FUNCTION_NAME,
+     pf.boundary_value_on_right as BOUNDARY_ON_RIGHT,
+     prv.boundary_id as BOUNDARY_ID,
+     prv.value as BOUNDARY_VALUE
+FROM sys.tables t
+INNER JOIN sys.schemas sch
+  ON sch.schema_id = t.schema_id
+INNER JOIN sys.indexes ind
+  ON  ind.object_id = t.object_id
+  AND ind.index_id IN (0, 1)
+INNER JOIN sys.partition_schemes ps
+  ON ps.data_space_id = ind.data_space_id
+INNER JOIN sys.partition_functions pf
+  ON pf.function_id = ps.function_id
+INNER JOIN sys.index_columns ic
+  ON  ic.object_id = ind.object_id
+  AND ic.index_id = ind.index_id
+  AND ic.partition_ordinal = 1
+INNER JOIN sys.columns col
+  ON  col.object_id = ic.object_id
+  AND col.column_id = ic.column_id
+LEFT JOIN sys.partition_range_values prv
+  ON prv.function_id = pf.function_id
+WHERE t.is_ms_shipped = 0
+  AND pf.type = 'R'
+ORDER BY sch.name, t.name, prv.boundary_id
+        """)
+
+        result = {}
+        for row in r:
+            if row['TABLE_SCHEMA'] not in self.param_exclude_schemas:
+                table_name = self.translate_table_name(row["TABLE_SCHEMA"], row["TABLE_NAME"])
+
+                if table_name not in result:
+                    result[table_name] = dict(
+                        original_schema=row['TABLE_SCHEMA'],
+                        original_table=row['TABLE_NAME'],
+                        original_column_name=row['COLUMN_NAME'],
+                        column_name=self.translate_a_name(row['COLUMN_NAME']),
+                        function_name=row['FUNCTION_NAME'],
+                        boundary_on_right=bool(row['BOUNDARY_ON_RIGHT']),
+                        boundaries=[],
+                    )
+
+                if row['BOUNDARY_ID'] is not None:
+                    result[table_name]['boundaries'].append(row['BOUNDARY_VALUE'])
+
+        # One child table per SQL Server partition number; the outermost ranges are open-ended
+        for table_name in result:
+            partition = result[table_name]
+            partition['default_table_name'] = self.translate_table_name(
+                partition['original_schema'], '{}_default'.format(partition['original_table']))
+
+            # PostgreSQL upper bounds are exclusive, RANGE LEFT ones are inclusive and move to the next value
+            boundaries = partition['boundaries']
+            partition['exact_bounds'] = True
+            if not partition['boundary_on_right']:
+                next_values = [self.translate_next_value(x) for x in boundaries]
+                if None in next_values:
+                    partition['exact_bounds'] = False
+                else:
+                    boundaries = next_values
+
+            bounds = ['MINVALUE'] + [self.translate_boundary_value(x) for x in boundaries] + ['MAXVALUE']
+            partition['children'] = []
+            for number in range(1, len(bounds)):
+                partition['children'].append(dict(
+                    number=number,
+                    table_name=self.translate_table_name(
+                        partition['original_schema'], '{}_p{}'.format(partition['original_table'], number)),
+                    lower=bounds[number-1],
+                    upper=bounds[number],
+                ))
+
+        return result
+
+    def read_clustered_indexes(self):
+        r = self.param_sql_session.execute("""
+SELECT sch.name as TABLE_SCHEMA,
+     t.name as TABLE_NAME,
+     ind.is_primary_key as IS_PRIMARY_KEY,
+     ind.is_unique_constraint as IS_UNIQUE_CONSTRAINT,
+     ind.fill_factor as FILL_FACTOR,
+     ic.is_descending_key as IS_DESCENDING_KEY,
+     col.name as COLUMN_NAME
+FROM sys.indexes ind
+INNER JOIN sys.index_columns ic
+  ON  ind.object_id = ic.object_id
+  AND ind.index_id = ic.index_id
+INNER JOIN sys.columns col
+  ON ic.object_id = col.object_id
+  AND ic.column_id = col.column_id
+INNER JOIN sys.tables t
+  ON ind.object_id = t.object_id
+INNER JOIN sys.schemas sch
+  ON sch.schema_id = t.schema_id
+WHERE ind.type = 1
+  AND ic.key_ordinal > 0
+  AND t.is_ms_shipped = 0
+ORDER BY sch.name, t.name, ic.key_ordinal
+        """)
+
+        result = {}
+        for row in r:
+            if row['TABLE_SCHEMA'] not in self.param_exclude_schemas:
+                table_name = self.translate_table_name(row["TABLE_SCHEMA"], row["TABLE_NAME"])
+
+                if table_name not in result:
+                    result[table_name] = dict(
+                        primary_key=bool(row['IS_PRIMARY_KEY']),
+                        unique_constraint=bool(row['IS_UNIQUE_CONSTRAINT']),
+                        fill_factor=self.translate_fill_factor(row['FILL_FACTOR']),
                         columns=[],
+                        order_by=[],
                     )
 
-                index['columns'].append(self.translate_a_name(row['COLUMN_NAME']))
+                result[table_name]['columns'].append(self.translate_a_name(row['COLUMN_NAME']))
+                result[table_name]['order_by'].append(
+                    '[{}]{}'.format(row['COLUMN_NAME'], ' DESC' if row['IS_DESCENDING_KEY'] else ''))
+
+        return result
+
+    def read_subset(self):
+        # Key sets are kept on the server in #temp tables of the session, keyed by primary key columns
+        original_names = dict([(x['translated_name'], x['original_name']) for x in self.tables])
+
+        keys = {}
+        for x in self.constraints_pk_uk:
+            if x['type'] == 'PRIMARY KEY':
+                if x['table'] not in keys:
+                    keys[x['table']] = []
+                keys[x['table']].append(x['original_column'])
+
+        # Without a primary key, the first UNIQUE constraint identifies rows
+        unique_keys = {}
+        for x in self.constraints_pk_uk:
+            if x['type'] == 'UNIQUE' and x['table'] not in keys:
+                if x['table'] not in unique_keys:
+                    unique_keys[x['table']] = dict(name=x['name'], columns=[])
+                if unique_keys[x['table']]['name'] == x['name']:
+                    unique_keys[x['table']]['columns'].append(x['original_column'])
+
+        foreign_keys = {}
+        for x in self.constraints_fk:
+            if x['table'] in original_names and x['pk_table'] in original_names:
+                if x['name'] not in foreign_keys:
+                    foreign_keys[x['name']] = dict(table=x['table'], pk_table=x['pk_table'], columns=[])
+                foreign_keys[x['name']]['columns'].append((x['original_column'], x['original_pk_column']))
+
+        result = {}
+
+        def key_set(table_name, referenced=False):
+            if table_name not in result:
+                if table_name in keys:
+                    key_columns = keys[table_name]
+                elif table_name in unique_keys:
+                    key_columns = unique_keys[table_name]['columns']
+                    self.output_progress('    {} has no primary key, keyed on UNIQUE ({}) without NULL keys'.format(
+                        table_name, ', '.join(key_columns)))
+                elif referenced:
+                    # Referenced rows cannot be told apart, the whole table keeps the foreign keys valid
+                    self.output_progress('    {} has no primary or unique key, exported in full'.format(table_name))
+                    result[table_name] = dict(temp_table=None, key_columns=[])
+                    return result[table_name]
+                else:
+                    self.output_progress('    {} has no primary or unique key, left out'.format(table_name))
+                    return None
+
+                result[table_name] = dict(
+                    temp_table='#subset_{}'.format(len(result) + 1),
+                    key_columns=key_columns,
+                )
+
+                key_definitions = []
+                for name in key_columns:
+                    for column in self.columns[table_name]:
+                        if column['name'] == name:
+                            key_definitions.append('[{}] {} NOT NULL'.format(name, self.original_column_type(column)))
+
+                self.param_sql_session.execute('CREATE TABLE {} ({}, PRIMARY KEY ({}))'.format(
+                    result[table_name]['temp_table'],
+                    ', '.join(key_definitions),
+                    ', '.join(['[{}]'.format(x) for x in key_columns])))
+
+            return result[table_name]
+
+        def add_keys(table_name, condition, top=None, referenced=False):
+            exported_in_full = table_name in result and result[table_name]['temp_table'] is None
+            target = key_set(table_name, referenced)
+            if target is None or exported_in_full:
+                return 0
+            if target['temp_table'] is None:
+                # Newly exported in full, its own parents still have to be pulled in
+                return 1
+
+            r = self.param_sql_session.execute("""
+INSERT INTO {temp_table}
+SELECT {top}{columns} FROM {table} t
+WHERE ({condition})
+  AND {not_null}
+  AND NOT EXISTS (SELECT 1 FROM {temp_table} s WHERE {match})
+            """.format(
+                temp_table=target['temp_table'],
+                top='' if top is None else 'TOP ({}) '.format(top),
+                columns=', '.join(['t.[{}]'.format(x) for x in target['key_columns']]),
+                table=original_names[table_name],
+                condition=condition,
+                not_null=' AND '.join(['t.[{}] IS NOT NULL'.format(x) for x in target['key_columns']]),
+                match=' AND '.join(['s.[{0}] = t.[{0}]'.format(x) for x in target['key_columns']]),
+            ))
+
+            return r.rowcount
+
+        def linked_rows(foreign_key, from_child, alias):
+            # Rows already in the subset on one side of the foreign key, linked to t on the other side
+            from_table = foreign_key['table'] if from_child else foreign_key['pk_table']
+            source = result[from_table]
+            if from_child:
+                link = ' AND '.join(['{}.[{}] = t.[{}]'.format(alias, c, p) for c, p in foreign_key['columns']])
+            else:
+                link = ' AND '.join(['{}.[{}] = t.[{}]'.format(alias, p, c) for c, p in foreign_key['columns']])
+
+            if source['temp_table'] is None:
+                return 'EXISTS (SELECT 1 FROM {} {} WHERE {})'.format(original_names[from_table], alias, link)
+
+            return 'EXISTS (SELECT 1 FROM {table} {alias} INNER JOIN {temp_table} s ON {match} WHERE {link})'.format(
+                table=original_names[from_table],
+                alias=alias,
+                temp_table=source['temp_table'],
+                match=' AND '.join(['s.[{0}] = {1}.[{0}]'.format(x, alias) for x in source['key_columns']]),
+                link=link,
+            )
+
+        # Explicit transaction, so the key tables are committed rather than rolled back with the statement
+        transaction = self.param_sql_session.begin()
+        try:
+            roots = []
+            for root in self.param_subset_roots:
+                root_table, _, predicate = root.partition(':')
+                if '.' in root_table:
+                    root_schema, root_table = root_table.split('.', 1)
+                else:
+                    root_schema = 'dbo'
+
+                table_name = self.translate_table_name(root_schema, root_table)
+                if table_name not in original_names:
+                    raise SystemExit('Subset root table {} not found'.format(root_table))
+
+                add_keys(table_name, predicate if predicate.strip() != '' else '1 = 1')
+                if table_name in result:
+                    roots.append(table_name)
+
+            if self.param_subset_children > 0:
+                for foreign_key in foreign_keys.values():
+                    if foreign_key['pk_table'] in roots:
+                        add_keys(foreign_key['table'], linked_rows(foreign_key, False, 'p'),
+                                 self.param_subset_children)
+
+            # Pull in referenced parent rows until no foreign key adds anything
+            added = True
+            while added:
+                added = False
+                for foreign_key in foreign_keys.values():
+                    if foreign_key['table'] in result:
+                        if add_keys(foreign_key['pk_table'], linked_rows(foreign_key, True, 'c'), referenced=True) > 0:
+                            added = True
+
+            transaction.commit()
+        except Exception:
+            transaction.rollback()
+            raise
 
         return result
 
@@ -663,15 +1156,35 @@ CREATE EXTENSION "uuid-ossp";
 
             self.write_string('CREATE TABLE {} ('.format(table_name))
             self.output_table_columns(table_name, table_columns)
-            self.write_string(');')
+            if table_name in self.partitions:
+                self.write_string(') PARTITION BY RANGE ({});'.format(self.partitions[table_name]['column_name']))
+                leaf_tables = self.output_partitions(table_name, table_columns)
+            else:
+                self.write_string(');')
+                leaf_tables = [table_name]
 
             pk = [x['column'] for x in self.constraints_pk_uk if x['table'] == table_name and x['type'] == 'PRIMARY KEY']
             if len(pk) > 0:
-                self.write_string('ALTER TABLE {} ADD PRIMARY KEY ({});'.format(table_name, ', '.join(pk)))
-
-            uk = [x['column'] for x in self.constraints_pk_uk if x['table'] == table_name and x['type'] == 'UNIQUE']
-            if len(uk) > 0:
-                self.write_string('ALTER TABLE {} ADD UNIQUE ({});'.format(table_name, ', '.join(uk)))
+                self.write_string('{}ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY ({});'.format(
+                    self.partition_key_comment(table_name, pk), table_name,
+                    self.primary_key_name(table['relation_name']), ', '.join(pk)))
+
+            uk = {}
+            for x in self.constraints_pk_uk:
+                if x['table'] == table_name and x['type'] == 'UNIQUE':
+                    if x['name'] not in uk:
+                        uk[x['name']] = []
+                    uk[x['name']].append(x['column'])
+
+            for uk_name in sorted(uk.keys()):
+                self.write_string('{}ALTER TABLE {} ADD UNIQUE ({});'.format(
+                    self.partition_key_comment(table_name, uk[uk_name]), table_name, ', '.join(uk[uk_name])))
+
+            # PostgreSQL only takes table fill factor on leaf tables
+            if table_name in self.clustered_indexes and self.clustered_indexes[table_name]['fill_factor'] is not None:
+                for leaf_table in leaf_tables:
+                    self.write_string('ALTER TABLE {} SET (fillfactor = {});'.format(
+                        leaf_table, self.clustered_indexes[table_name]['fill_factor']))
 
             check = [x['clause'] for x in self.constraints_check if x['table'] == table_name]
             if len(check) > 0:
@@ -679,6 +1192,38 @@ CREATE EXTENSION "uuid-ossp";
 
             self.write_string('')
 
+    def output_partitions(self, table_name, table_columns):
+        partition = self.partitions[table_name]
+
+        if not partition['exact_bounds']:
+            self.write_string(('-- RANGE LEFT function {}: rows equal to a boundary land in the next partition,' +
+                               ' data is loaded through {}').format(partition['function_name'], table_name))
+
+        result = []
+        for child in partition['children']:
+            self.write_string('CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({});'.format(
+                child['table_name'], table_name, child['lower'], child['upper']))
+            result.append(child['table_name'])
+
+        # SQL Server keeps NULL keys in the first partition, PostgreSQL needs a default one for them
+        for column in table_columns:
+            if column['translated_name'] == partition['column_name'] and column['nullable'] != 'NO':
+                self.write_string('CREATE TABLE {} PARTITION OF {} DEFAULT;'.format(
+                    partition['default_table_name'], table_name))
+                result.append(partition['default_table_name'])
+
+        return result
+
+    def partition_key_comment(self, table_name, columns):
+        # Unique constraints on a partitioned table must include the partition key in PostgreSQL
+        result = ''
+        if table_name in self.partitions:
+            key_columns = [x[0:len(x)-len(' DESC')] if x.endswith(' DESC') else x for x in columns]
+            if self.partitions[table_name]['column_name'] not in key_columns:
+                result = '-- not partition-aligned: '
+
+        return result
+
     def output_data(self):
         if len(self.tables) > 0:
             self.output_section('INSERT DATA')
@@ -698,47 +1243,115 @@ CREATE EXTENSION "uuid-ossp";
             else:
                 sequence = None
 
-            r = self.param_sql_session.execute("SELECT * FROM {}".format(table['original_name']))
+            conditions = []
+            if self.subset is not None:
+                if table['translated_name'] not in self.subset:
+                    continue
+
+                subset = self.subset[table['translated_name']]
+                if subset['temp_table'] is not None:
+                    conditions.append('EXISTS (SELECT 1 FROM {} s WHERE {})'.format(
+                        subset['temp_table'],
+                        ' AND '.join(['s.[{0}] = t.[{0}]'.format(x) for x in subset['key_columns']])))
+
+            if table['translated_name'] in self.partitions:
+                # Each partition is extracted and loaded as a separate COPY straight into its child table
+                partition = self.partitions[table['translated_name']]
+                column_name = partition['original_column_name']
+                copies = []
+                for child in partition['children']:
+                    copies.append((
+                        child['table_name'] if partition['exact_bounds'] else table['translated_name'],
+                        ['$PARTITION.[{}](t.[{}]) = {}'.format(partition['function_name'], column_name, child['number']),
+                         't.[{}] IS NOT NULL'.format(column_name)],
+                        '{} partition {}'.format(table['translated_name'], child['number'])))
+
+                # SQL Server keeps NULL keys in the first partition, PostgreSQL in the default one
+                if len([x for x in table_columns if x['name'] == column_name and x['nullable'] != 'NO']) > 0:
+                    copies.append((
+                        partition['default_table_name'] if partition['exact_bounds'] else table['translated_name'],
+                        ['t.[{}] IS NULL'.format(column_name)],
+                        '{} default partition'.format(table['translated_name'])))
+
+                row_count = 0
+                for target_name, partition_conditions, caption in copies:
+                    query = self.select_query(table, partition_conditions + conditions)
+                    row_count += self.output_table_data(
+                        query, target_name, table_columns, sequence,
+                        self.param_max_record_count - row_count, caption)
+                    if row_count >= self.param_max_record_count:
+                        break
+            else:
+                query = self.select_query(table, conditions)
+                self.output_table_data(
+                    query, table['translated_name'], table_columns, sequence,
+                    self.param_max_record_count, table['translated_name'])
+
+    def select_query(self, table, conditions):
+        result = 'SELECT * FROM {} t'.format(table['original_name'])
+
+        if len(conditions) > 0:
+            result += ' WHERE {}'.format(' AND '.join(conditions))
 
-            row_count = 0
-            header_printed = False
-            for row in r:
-                if not header_printed:
-                    self.write_string('\echo')
-                    self.write_string('\echo Importing table [{}]'.format(table['translated_name']))
-                    self.write_string('\echo')
+        if self.param_clustered_order and table['translated_name'] in self.clustered_indexes:
+            result += ' ORDER BY {}'.format(
+                ', '.join(['t.' + x for x in self.clustered_indexes[table['translated_name']]['order_by']]))
 
-                    column_string = ', '.join([column['translated_name'] for column in table_columns])
-                    self.write_string('COPY {} ({}) FROM stdin;'.format(table['translated_name'], column_string))
-                    header_printed = True
+        return result
+
+    def output_table_data(self, query, table_name, table_columns, sequence, max_record_count, caption):
+        r = self.param_sql_session.execute(query)
 
-                if sequence is not None:
-                    sequence['max_value'] = max(sequence['max_value'], row[sequence['original_column_name']])
+        row_count = 0
+        header_printed = False
+        for row in r:
+            if not header_printed:
+                self.write_string('\\echo')
+                self.write_string('\\echo Importing table [{}]'.format(caption))
+                self.write_string('\\echo')
 
-                row_data = []
-                for column in table_columns:
-                    cell = self.translate_data(row[column['name']], column['translated_type'])
-                    row_data.append(cell)
+                column_string = ', '.join([column['translated_name'] for column in table_columns])
+                self.write_string('COPY {} ({}) FROM stdin;'.format(table_name, column_string))
+                header_printed = True
 
-                self.write_string('\t'.join(row_data))
+            if sequence is not None:
+                sequence['max_value'] = max(sequence['max_value'], row[sequence['original_column_name']])
 
-                row_count += 1
-                if row_count >= self.param_max_record_count:
-                    break
+            row_data = []
+            for column in table_columns:
+                cell = self.translate_data(row[column['name']], column['translated_type'])
+                row_data.append(cell)
 
-            if header_printed:
-                self.write_string('\\.\n\n')
+            self.write_string('\t'.join(row_data))
+
+            row_count += 1
+            if row_count >= max_record_count:
+                break
+
+        if header_printed:
+            self.write_string('\\.\n\n')
+
+        return row_count
 
     def output_fk_constraints(self):
         if len(self.constraints_fk) > 0:
             self.output_section('CREATE REFERENTIAL CONSTRAINTS')
 
-        for constraint in self.constraints_fk:
-            self.write_string('ALTER TABLE {} ADD FOREIGN KEY ({}) REFERENCES {}({});'.format(
+        constraints = []
+        for x in self.constraints_fk:
+            if len(constraints) == 0 or constraints[-1]['name'] != x['name']:
+                constraints.append(dict(name=x['name'], table=x['table'], pk_table=x['pk_table'], columns=[], pk_columns=[]))
+            constraints[-1]['columns'].append(x['column'])
+            constraints[-1]['pk_columns'].append(x['pk_column'])
+
+        for constraint in constraints:
+            # The referenced key is commented out when it is not partition-aligned, so is the reference
+            self.write_string('{}ALTER TABLE {} ADD FOREIGN KEY ({}) REFERENCES {}({});'.format(
+                self.partition_key_comment(constraint['pk_table'], constraint['pk_columns']),
                 constraint['table'],
-                constraint['column'],
+                ', '.join(constraint['columns']),
                 constraint['pk_table'],
-                constraint['pk_column'],
+                ', '.join(constraint['pk_columns']),
             ))
 
     def output_indexes(self):
@@ -746,8 +1359,23 @@ CREATE EXTENSION "uuid-ossp";
             self.output_section('CREATING INDEXES')
 
         for index in self.indexes:
-            index_columns = ', '.join(index['columns'])
-            index_definition = 'CREATE INDEX {} on {}({});'.format(index['index_name'], index['table_name'], index_columns)
+            if not index['filter_translatable']:
+                comment = '-- filter needs manual translation: '
+            elif index['unique']:
+                comment = self.partition_key_comment(index['table_name'], index['columns'])
+            else:
+                comment = ''
+
+            index_definition = '{comment}CREATE {unique}INDEX {name} on {table}({columns}){include}{fill}{where};'.format(
+                comment=comment,
+                unique='UNIQUE ' if index['unique'] else '',
+                name=index['index_name'],
+                table=index['table_name'],
+                columns=', '.join(index['columns']),
+                include='' if len(index['included_columns']) == 0 else ' INCLUDE ({})'.format(', '.join(index['included_columns'])),
+                fill='' if index['fill_factor'] is None else ' WITH (fillfactor = {})'.format(index['fill_factor']),
+                where='' if index['filter'] is None else ' WHERE {}'.format(index['filter']),
+            )
 
             self.write_string(index_definition)
 
@@ -770,5 +1398,447 @@ CREATE EXTENSION "uuid-ossp";
 
             self.write_string(sequence_definition)
 
+    def primary_key_name(self, relation_name):
+        # Primary keys are named explicitly, so CLUSTER ON can refer to them; identifiers keep 63 characters
+        if relation_name.endswith('"'):
+            result = '{}_pkey"'.format(relation_name[0:min(len(relation_name)-1, 1+63-len('_pkey'))])
+        else:
+            result = '{}_pkey'.format(relation_name[0:63-len('_pkey')])
+
+        return result
+
+    def output_analyze(self):
+        if len(self.tables) > 0:
+            self.output_section('CLUSTER HINTS AND STATISTICS')
+
+        # Mark the index matching the SQL Server clustered index, so later CLUSTER runs keep the same order
+        for table in self.tables:
+            table_name = table['translated_name']
+            if table_name in self.clustered_indexes and table_name not in self.partitions:
+                if self.clustered_indexes[table_name]['primary_key']:
+                    self.write_string('ALTER TABLE {} CLUSTER ON {};'.format(table_name, self.primary_key_name(table['relation_name'])))
+                elif self.clustered_indexes[table_name]['unique_constraint']:
+                    # PostgreSQL picks the name of the index behind an unnamed UNIQUE constraint itself
+                    self.write_string('-- ALTER TABLE {} CLUSTER ON <index of UNIQUE ({})>;'.format(
+                        table_name, ', '.join(self.clustered_indexes[table_name]['columns'])))
+                else:
+                    for index in self.indexes:
+                        if index['table_name'] == table_name and index['clustered']:
+                            self.write_string('ALTER TABLE {} CLUSTER ON {};'.format(table_name, index['index_name']))
+
+        if self.param_analyze_jobs > 0:
+            self.write_string('\\! vacuumdb --analyze-only --jobs={} {}'.format(
+                self.param_analyze_jobs, self.param_destination_database))
+        else:
+            for table in self.tables:
+                self.write_string('ANALYZE {};'.format(table['translated_name']))
+
+    ###########################################################################
+    # Verification
+
+    def verify_expressions(self, column):
+        # Canonical text of a value, computed the same way by SQL Server, PostgreSQL and from COPY data
+        column_type = column['type'].lower()
+        name = '[{}]'.format(column['name'])
+        pg_name = '{}::text'.format(column['translated_name'])
+
+        if column_type in ('int', 'bigint', 'smallint', 'tinyint', 'decimal', 'numeric'):
+            result = ('CONVERT(VARCHAR(64), t.{})'.format(name), pg_name)
+        elif column_type == 'bit':
+            result = ("CASE t.{} WHEN 1 THEN 'true' WHEN 0 THEN 'false' END".format(name), pg_name)
+        elif column_type in ('char', 'nchar'):
+            result = ('RTRIM(t.{})'.format(name), pg_name)
+        elif column_type in ('varchar', 'nvarchar', 'text', 'ntext'):
+            result = ('CAST(t.{} AS NVARCHAR(MAX))'.format(name), pg_name)
+        elif column_type == 'uniqueidentifier':
+            result = ('LOWER(CONVERT(VARCHAR(36), t.{}))'.format(name), pg_name)
+        elif column_type in ('datetime', 'smalldatetime', 'datetime2'):
+            result = ("CONVERT(VARCHAR(24), DATEDIFF_BIG(ms, '1970-01-01', t.{}))".format(name),
+                      'floor(extract(epoch from {}) * 1000)::bigint::text'.format(column['translated_name']))
+        elif column_type == 'date':
+            result = ("CONVERT(VARCHAR(12), DATEDIFF(day, '1970-01-01', t.{}))".format(name),
+                      "({} - date '1970-01-01')::text".format(column['translated_name']))
+        else:
+            result = None
+
+        return result
+
+    def verify_canonical(self, column, value):
+        column_type = column['type'].lower()
+
+        if value is None:
+            result = '\\N'
+        elif column_type == 'bit':
+            result = 'true' if value.lower() in ('t', 'true', 'y', 'yes', 'on', '1') else 'false'
+        elif column_type in ('char', 'nchar'):
+            result = value.rstrip(' ')
+        elif column_type in ('decimal', 'numeric'):
+            # str(Decimal) may use exponent notation (0E-8), SQL Server and PostgreSQL use fixed point
+            result = '{:f}'.format(decimal.Decimal(value))
+        elif column_type == 'uniqueidentifier':
+            result = value.lower()
+        elif column_type in ('datetime', 'smalldatetime', 'datetime2'):
+            delta = self.verify_key_value(column, value) - datetime.datetime(1970, 1, 1)
+            result = str((delta.days * 86400000000 + delta.seconds * 1000000 + delta.microseconds) // 1000)
+        elif column_type == 'date':
+            result = str((self.verify_key_value(column, value) - datetime.date(1970, 1, 1)).days)
+        else:
+            result = value
+
+        return result
+
+    def verify_key_value(self, column, value):
+        # Typed value for key range comparison, None if ranges cannot be compared outside SQL Server
+        column_type = column['type'].lower()
+
+        if value is None:
+            result = None
+        elif column_type in ('int', 'bigint', 'smallint', 'tinyint'):
+            result = int(value)
+        elif column_type in ('decimal', 'numeric'):
+            result = decimal.Decimal(value)
+        elif column_type in ('datetime', 'smalldatetime', 'datetime2'):
+            value = value.replace('T', ' ')
+            result = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S')
+        elif column_type == 'date':
+            result = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        else:
+            result = None
+
+        return result
+
+    def verify_unescape(self, value):
+        # Same rules as PostgreSQL COPY text format
+        if value == '\\N':
+            return None
+
+        escapes = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+        result = []
+        i = 0
+        while i < len(value):
+            if value[i] == '\\' and i + 1 < len(value):
+                i += 1
+                result.append(escapes.get(value[i], value[i]))
+            else:
+                result.append(value[i])
+            i += 1
+
+        return ''.join(result)
+
+    def verify_row_hash(self, values):
+        return int(hashlib.md5('|'.join(values).encode('utf-8')).hexdigest()[0:8], 16)
+
+    def verify_hash_sql(self, expressions):
+        # First 4 bytes of MD5 over UTF-8 text as unsigned integer, so SUM over a chunk is order-independent
+        row_text = " + N'|' + ".join(["COALESCE({}, N'\\N')".format(x) for x in expressions]) or "N''"
+
+        return "CAST(CONVERT(BINARY(4), HASHBYTES('MD5', CAST(({}) COLLATE Latin1_General_100_BIN2_UTF8 AS VARCHAR(MAX)))) AS BIGINT)".format(
+            row_text)
+
+    def verify_pg_hash_sql(self, expressions):
+        if len(expressions) > 0:
+            row_text = "concat_ws('|', {})".format(', '.join(["coalesce({}, '\\N')".format(x) for x in expressions]))
+        else:
+            row_text = "''"
+
+        return "('x' || substr(md5({}), 1, 8))::bit(32)::bigint".format(row_text)
+
+    def verify_table_definition(self, table):
+        table_columns = self.columns[table['translated_name']]
+        key_names = [x['original_column'] for x in self.constraints_pk_uk
+                     if x['table'] == table['translated_name'] and x['type'] == 'PRIMARY KEY']
+
+        columns = [x for x in table_columns if self.verify_expressions(x) is not None]
+        key_columns = [x for name in key_names for x in table_columns if x['name'] == name]
+
+        # Without a canonical text for every key column, rows cannot be matched by key
+        key_comparable = all([x in columns for x in key_columns])
+        if not key_comparable:
+            key_columns = []
+
+        return dict(
+            table=table,
+            columns=columns,
+            skipped_columns=[x['translated_name'] for x in table_columns if x not in columns],
+            key_columns=key_columns,
+            key_comparable=key_comparable,
+            hash=self.verify_hash_sql([self.verify_expressions(x)[0] for x in columns]),
+            pg_hash=self.verify_pg_hash_sql([self.verify_expressions(x)[1] for x in columns]),
+            rangeable=len(key_columns) > 0 and all([x['type'].lower() in (
+                'int', 'bigint', 'smallint', 'tinyint', 'decimal', 'numeric', 'date', 'datetime', 'smalldatetime',
+                'datetime2') for x in key_columns]),
+        )
+
+    def read_verify_target(self):
+        tables = dict([(x['translated_name'], x) for x in self.tables])
+
+        # Only \n ends a row, str.splitlines() would also split on characters COPY text leaves as is
+        try:
+            target_file = io.open(self.param_verify_file, 'r', encoding='utf-8', newline='\n')
+        except Exception as e:
+            raise SystemExit('Error opening file {}: {}'.format(self.param_verify_file, e))
+
+        result = {}
+        try:
+            definition = None
+            for line in target_file:
+                line = line[0:len(line)-1] if line.endswith('\n') else line
+
+                if definition is None:
+                    match = re.match(r'^COPY (.+) \((.*)\) FROM stdin;$', line)
+                    if match is not None and match.group(1) in tables:
+                        definition = self.verify_table_definition(tables[match.group(1)])
+                        copy_columns = match.group(2).split(', ')
+                        rows = result.setdefault(match.group(1), [])
+                elif line == '\\.':
+                    definition = None
+                else:
+                    values = [self.verify_unescape(x) for x in line.split('\t')]
+                    row = dict(zip(copy_columns, values))
+                    canonical = [self.verify_canonical(x, row.get(x['translated_name'])) for x in definition['columns']]
+                    key = [self.verify_canonical(x, row.get(x['translated_name'])) for x in definition['key_columns']]
+                    range_key = None
+                    if definition['rangeable']:
+                        range_key = tuple([self.verify_key_value(x, row.get(x['translated_name']))
+                                           for x in definition['key_columns']])
+
+                    rows.append((range_key, tuple(key), self.verify_row_hash(canonical)))
+        finally:
+            target_file.close()
+
+        return result
+
+    def verify_range_condition(self, names, lower, upper, placeholder):
+        # Key tuples compare lexicographically: (a, b) > (x, y) is a > x OR (a = x AND b > y)
+        conditions = []
+        parameters = {}
+        for bound, prefix, operator, last_operator in ((lower, 'lower', '>', '>'), (upper, 'upper', '<', '<=')):
+            if bound is None:
+                continue
+
+            alternatives = []
+            for i in range(len(names)):
+                terms = ['{} = {}'.format(names[j], placeholder('{}{}'.format(prefix, j), bound[j])) for j in range(i)]
+                terms.append('{} {} {}'.format(
+                    names[i], last_operator if i == len(names) - 1 else operator,
+                    placeholder('{}{}'.format(prefix, i), bound[i])))
+                alternatives.append('({})'.format(' AND '.join(terms)))
+
+            conditions.append('({})'.format(' OR '.join(alternatives)))
+            for i in range(len(names)):
+                parameters['{}{}'.format(prefix, i)] = bound[i]
+
+        return ' AND '.join(conditions) if len(conditions) > 0 else '1 = 1', parameters
+
+    def verify_source_condition(self, definition, lower, upper):
+        return self.verify_range_condition(
+            ['t.[{}]'.format(x['name']) for x in definition['key_columns']], lower, upper,
+            lambda name, value: ':{}'.format(name))
+
+    def verify_pg_condition(self, definition, lower, upper):
+        return self.verify_range_condition(
+            [x['translated_name'] for x in definition['key_columns']], lower, upper,
+            lambda name, value: '%({})s'.format(name))
+
+    def verify_pg_query(self, definition, lower, upper):
+        # Same check for a live PostgreSQL target
+        condition, _ = self.verify_range_condition(
+            [x['translated_name'] for x in definition['key_columns']], lower, upper,
+            lambda name, value: self.translate_boundary_value(value))
+
+        return 'SELECT count(*), sum({}) FROM {} WHERE {};'.format(
+            definition['pg_hash'], definition['table']['translated_name'], condition)
+
+    def verify_target_range(self, target, definition, lower, upper):
+        # COPY file rows are narrowed down with the range, a database target filters by itself
+        if 'rows' in target and definition['rangeable']:
+            target = dict(rows=[x for x in target['rows']
+                                if (lower is None or x[0] > lower) and (upper is None or x[0] <= upper)])
+
+        return target
+
+    def verify_target_totals(self, target, definition, lower, upper):
+        if 'rows' in target:
+            result = len(target['rows']), sum([x[2] for x in target['rows']])
+        else:
+            condition, parameters = self.verify_pg_condition(definition, lower, upper)
+            cursor = target['connection'].cursor()
+            try:
+                cursor.execute('SELECT count(*), coalesce(sum({}), 0) FROM {} WHERE {}'.format(
+                    definition['pg_hash'], definition['table']['translated_name'], condition), parameters)
+                row = cursor.fetchone()
+            finally:
+                cursor.close()
+            result = int(row[0]), int(row[1])
+
+        return result
+
+    def verify_target_keys(self, target, definition, lower, upper):
+        if 'rows' in target:
+            result = dict([(x[1], x[2]) for x in target['rows']])
+        else:
+            condition, parameters = self.verify_pg_condition(definition, lower, upper)
+            cursor = target['connection'].cursor()
+            try:
+                cursor.execute('SELECT {}, {} FROM {} WHERE {}'.format(
+                    ', '.join(["coalesce({}, '\\N')".format(self.verify_expressions(x)[1]) for x in definition['key_columns']]),
+                    definition['pg_hash'], definition['table']['translated_name'], condition), parameters)
+                result = dict([(tuple(row[0:len(row)-1]), int(row[-1])) for row in cursor])
+            finally:
+                cursor.close()
+
+        return result
+
+    def verify_range(self, session, target, definition, lower, upper, depth, report):
+        table = definition['table']
+        condition, bounds = self.verify_source_condition(definition, lower, upper)
+        target = self.verify_target_range(target, definition, lower, upper)
+
+        # Row hashes go up to 2^32, BIGINT sums would overflow after 2^31 rows
+        row = session.execute(
+            'SELECT COUNT_BIG(*) ROW_COUNT, SUM(CAST({} AS DECIMAL(38, 0))) ROW_HASH FROM {} t WHERE {}'.format(
+                definition['hash'], table['original_name'], condition), bounds).fetchone()
+        source_count, source_hash = int(row['ROW_COUNT']), int(row['ROW_HASH'] or 0)
+        target_count, target_hash = self.verify_target_totals(target, definition, lower, upper)
+
+        if source_count == target_count and source_hash == target_hash:
+            return False
+
+        report.append('-- {}range ({} .. {}]: source {} rows, target {} rows{}'.format(
+            '    ' * depth,
+            ', '.join([str(x) for x in lower]) if lower is not None else '',
+            ', '.join([str(x) for x in upper]) if upper is not None else '',
+            source_count, target_count, '' if source_count != target_count else ', hash differs'))
+        if 'rows' in target:
+            report.append('-- {}    target check: {}'.format('    ' * depth, self.verify_pg_query(definition, lower, upper)))
+
+        if definition['rangeable'] and max(source_count, target_count) > self.param_verify_leaf_rows:
+            # Keys are unique, so ranges only stop getting smaller when the source has at most one row in them
+            ranges = self.verify_split_range(session, definition, lower, upper)
+            if len(ranges) > 1:
+                for sub_lower, sub_upper in ranges:
+                    self.verify_range(session, target, definition, sub_lower, sub_upper, depth + 1, report)
+                return True
+
+        if len(definition['key_columns']) == 0:
+            return True
+
+        # Small enough, compare rows by primary key
+        key_expressions = ['{} K{}'.format(self.verify_expressions(x)[0], i) for i, x in enumerate(definition['key_columns'])]
+        r = session.execute('SELECT {}, {} ROW_HASH FROM {} t WHERE {}'.format(
+            ', '.join(key_expressions), definition['hash'], table['original_name'], condition), bounds)
+
+        source_rows = {}
+        for source_row in r:
+            key = tuple(['\\N' if source_row['K{}'.format(i)] is None else source_row['K{}'.format(i)]
+                         for i in range(len(key_expressions))])
+            source_rows[key] = source_row['ROW_HASH']
+        target_keys = self.verify_target_keys(target, definition, lower, upper)
+
+        for key in sorted(set(source_rows.keys()) | set(target_keys.keys())):
+            if key not in target_keys:
+                problem = 'missing in target'
+            elif key not in source_rows:
+                problem = 'not in source'
+            elif source_rows[key] != target_keys[key]:
+                problem = 'differs'
+            else:
+                continue
+            report.append('-- {}    key ({}) {}'.format('    ' * depth, ', '.join(key), problem))
+
+        return True
+
+    def verify_split_range(self, session, definition, lower, upper):
+        condition, bounds = self.verify_source_condition(definition, lower, upper)
+        key_count = len(definition['key_columns'])
+        r = session.execute("""
+SELECT {keys}
+FROM (SELECT {keys}, CHUNK, ROW_NUMBER() OVER (PARTITION BY CHUNK ORDER BY {keys_descending}) RN
+      FROM (SELECT {key_columns}, NTILE({chunks}) OVER (ORDER BY {key_order}) CHUNK
+            FROM {table} t WHERE {condition}) c) x
+WHERE RN = 1
+ORDER BY CHUNK
+        """.format(
+            keys=', '.join(['K{}'.format(i) for i in range(key_count)]),
+            keys_descending=', '.join(['K{} DESC'.format(i) for i in range(key_count)]),
+            key_columns=', '.join(['t.[{}] K{}'.format(x['name'], i) for i, x in enumerate(definition['key_columns'])]),
+            key_order=', '.join(['t.[{}]'.format(x['name']) for x in definition['key_columns']]),
+            chunks=self.param_verify_chunks,
+            table=definition['table']['original_name'],
+            condition=condition,
+        ), bounds)
+
+        # Ranges are contiguous, the last one stays open so target-only keys are still covered
+        result = []
+        bounds = [tuple([row['K{}'.format(i)] for i in range(key_count)]) for row in r]
+        previous = lower
+        for bound in bounds[0:len(bounds)-1]:
+            result.append((previous, bound))
+            previous = bound
+        result.append((previous, upper))
+
+        return result
+
+    def verify_table(self, arguments):
+        table, target = arguments
+        definition = self.verify_table_definition(table)
+
+        mismatch = False
+        report = []
+        if not definition['key_comparable']:
+            report.append('-- primary key cannot be compared, table compared as a whole')
+        elif len(definition['key_columns']) == 0:
+            report.append('-- no primary key, compared as a whole')
+
+        session = self.param_sql_session_maker()
+        if target is None:
+            target = dict(connection=psycopg2.connect(self.param_verify_target))
+        try:
+            if definition['rangeable']:
+                ranges = self.verify_split_range(session, definition, None, None)
+            else:
+                ranges = [(None, None)]
+
+            for lower, upper in ranges:
+                if self.verify_range(session, target, definition, lower, upper, 0, report):
+                    mismatch = True
+        finally:
+            session.close()
+            if 'connection' in target:
+                target['connection'].close()
+
+        if len(definition['skipped_columns']) > 0:
+            report.append('-- not compared: {}'.format(', '.join(definition['skipped_columns'])))
+
+        return mismatch, report
+
+    def output_verification(self, target):
+        self.output_section('VERIFICATION')
+
+        # Without target file data every job opens its own PostgreSQL connection
+        if target is not None:
+            arguments = [(x, dict(rows=target.get(x['translated_name'], []))) for x in self.tables]
+        else:
+            arguments = [(x, None) for x in self.tables]
+
+        pool = ThreadPool(max(self.param_verify_jobs, 1))
+        try:
+            reports = pool.map(self.verify_table, arguments)
+        finally:
+            pool.close()
+
+        mismatches = 0
+        for table, (mismatch, report) in zip(self.tables, reports):
+            if mismatch:
+                mismatches += 1
+                self.write_string('-- {}: MISMATCH'.format(table['translated_name']))
+            else:
+                self.write_string('-- {}: OK'.format(table['translated_name']))
+
+            for line in report:
+                self.write_string(line)
+
+        self.write_string('-- {} of {} tables differ'.format(mismatches, len(self.tables)))
+
 converter = MsSql2Pg()
 converter.run()